@@ -9,15 +9,71 @@
 #  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
+import array
+import asyncio
+import contextlib
+import datetime
+import functools
+import hashlib
 import json
+import math
 import os
-from typing import List
+import re
+import sqlite3
+import tempfile
+import time
+from typing import (Awaitable, Callable, Iterable, Iterator, List, Optional,
+                    TypeVar)
 
+import aiohttp
 import click
 import google.generativeai as genai
 import requests
+from google.api_core import exceptions as google_exceptions
 from loguru import logger
 
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Maximum number of concurrent requests to the Gemini API
+GEMINI_CONCURRENCY = 5
+# Fraction of the chunk size in tokens to aim for, since tokens are not evenly spread over a diff
+TOKEN_CHUNK_MARGIN = 0.9
+# Rough number of characters per token, used when a string is too large to be counted
+CHARS_PER_TOKEN_ESTIMATE = 4
+# Maximum number of concurrent requests to the GitHub API
+GITHUB_CONCURRENCY = 10
+# Maximum number of files requested in a single GitHub GraphQL query
+GITHUB_GRAPHQL_BATCH_SIZE = 100
+
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+
+COMMAND_MAP = {
+    "gemini review all": "all",
+    "gemini review diff": "diff",
+    "gemini suggest next steps": "suggest"
+}
+COMMAND_PATTERN = re.compile("^(" + "|".join(re.escape(command) for command in COMMAND_MAP) + ")")
+
+# Up to this many chunk reviews are summarized without asking Gemini
+LOCAL_SUMMARY_MAX_REVIEWS = 3
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s")
+# Markdown headings, emphasis-only lines such as **Summary:** and horizontal rules
+HEADING_LINE_PATTERN = re.compile(r"^(#+\s.*|([*_]{1,3})[^*_]+\2:?|[*_]{1,3}[^*_]+:[*_]{1,3}|[-*_]{3,})$")
+
+# API key genai was last configured with
+_configured_api_key = None
+
+RESPONSE_CACHE_FILE_NAME = "gemini-code-review-cache.sqlite3"
+
+# Gemini refuses to create context caches smaller than this
+CONTEXT_CACHE_MIN_TOKENS = 32768
+CONTEXT_CACHE_TTL = datetime.timedelta(minutes=10)
+
+EMBEDDING_MODEL = "models/text-embedding-004"
+# Longer chunks would be truncated by the embedding model and only compared on their beginning
+SEMANTIC_CACHE_MAX_CHARS = 6000
+
 
 def check_required_env_vars():
     """Check required environment variables"""
@@ -41,7 +97,7 @@ def get_review_prompt(extra_prompt: str = "") -> str:
     Can you tell me the issues with differences in a pull request and provide suggestions to improve it?
     You can provide a review summary and issue comments per file if any major issues are found.
     Always include the name of the file that is citing the improvement or problem.
-    In the next messages I will be sending you the difference between the GitHub file codes, okay?
+    Each message will contain the difference between the GitHub file codes.
     """
     return template
 
@@ -56,6 +112,17 @@ def get_summarize_prompt() -> str:
     return template
 
 
+@functools.lru_cache(maxsize=None)
+def get_github_session(github_token: str) -> requests.Session:
+    """Get a session reusing its connections to the GitHub API"""
+    session = requests.Session()
+    session.headers.update({
+        "Accept": "application/vnd.github+json",
+        "authorization": f"Bearer {github_token}"
+    })
+    return session
+
+
 def create_a_comment_to_pull_request(
         github_token: str,
         github_repository: str,
@@ -63,29 +130,317 @@ def create_a_comment_to_pull_request(
         git_commit_hash: str,
         body: str):
     """Create a comment to a pull request"""
-    headers = {
-        "Accept": "application/vnd.github.v3.patch",
-        "authorization": f"Bearer {github_token}"
-    }
     data = {
         "body": body,
         "commit_id": git_commit_hash,
         "event": "COMMENT"
     }
     url = f"https://api.github.com/repos/{github_repository}/pulls/{pull_request_number}/reviews"
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = get_github_session(github_token).post(url, json=data)
     return response
 
 
-def chunk_string(input_string: str, chunk_size) -> List[str]:
-    """Chunk a string"""
-    chunked_inputs = []
-    for i in range(0, len(input_string), chunk_size):
-        chunked_inputs.append(input_string[i:i + chunk_size])
-    return chunked_inputs
+def configure_genai(api_key: str):
+    """Configure the Gemini client, only once per API key"""
+    global _configured_api_key  # pylint: disable=global-statement
+    if _configured_api_key != api_key:
+        genai.configure(api_key=api_key)
+        _configured_api_key = api_key
+        # Cached models hold clients created with the previous API key
+        _build_model.cache_clear()
 
 
-def get_review(
+@functools.lru_cache(maxsize=4)
+def _build_model(
+        loop: Optional[asyncio.AbstractEventLoop],
+        model: str,
+        system_instruction: Optional[str],
+        generation_config_json: str
+) -> genai.GenerativeModel:
+    """Build a Gemini model, reused along with its channel by later calls in the same event loop"""
+    return genai.GenerativeModel(model_name=model,
+                                 generation_config=json.loads(generation_config_json),
+                                 system_instruction=system_instruction)
+
+
+def get_model(model: str, generation_config: dict = None, system_instruction: str = None) -> genai.GenerativeModel:
+    """Get a Gemini model"""
+    # The async client of a model is tied to the event loop that first used it
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    return _build_model(loop, model, system_instruction, json.dumps(generation_config or {}, sort_keys=True))
+
+
+def retry_on_rate_limit(max_attempts: int = 5):
+    """Retry a coroutine with exponential backoff when the Gemini API rate limits us"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(max_attempts):
+                try:
+                    return await func(*args, **kwargs)
+                except google_exceptions.ResourceExhausted:
+                    if attempt == max_attempts - 1:
+                        raise
+                    delay = 10 * 2 ** attempt
+                    logger.warning(f"Rate limited by Gemini API, retrying in {delay} seconds")
+                    await asyncio.sleep(delay)
+        return wrapper
+    return decorator
+
+
+def chunk_string(input_string: str, chunk_size: int) -> Iterator[str]:
+    """Chunk a string lazily, cutting on the last line break of a chunk when it is in its second half"""
+    start = 0
+    while start < len(input_string):
+        end = start + chunk_size
+        if end < len(input_string):
+            # A line break early in the chunk would leave a tiny chunk costing a whole request
+            line_break = input_string.rfind("\n", start + chunk_size // 2, end)
+            if line_break != -1:
+                end = line_break + 1
+        yield input_string[start:end]
+        start = end
+
+
+@retry_on_rate_limit()
+async def chunk_by_tokens(model: str, input_string: str, max_tokens: int) -> Iterator[str]:
+    """Chunk a string so that every chunk holds about max_tokens tokens of the model"""
+    if not input_string:
+        return iter(())
+    # A token is at least one character, so a short enough string fits without counting its tokens
+    if len(input_string) <= max_tokens:
+        return iter([input_string])
+    try:
+        total_tokens = (await get_model(model).count_tokens_async(input_string)).total_tokens
+    except google_exceptions.InvalidArgument as e:
+        # The string may be too large to be counted at once
+        logger.warning(f"Unable to count tokens, estimating them from the length: {e}")
+        total_tokens = len(input_string) // CHARS_PER_TOKEN_ESTIMATE + 1
+    if total_tokens <= max_tokens:
+        return iter([input_string])
+    # Cut on characters using the average number of characters per token of the whole string
+    chunk_size = max(1, int(len(input_string) * max_tokens / total_tokens * TOKEN_CHUNK_MARGIN))
+    return chunk_string(input_string, chunk_size)
+
+
+async def map_bounded(func: Callable[[T], Awaitable[R]], items: Iterable[T], concurrency: int) -> List[R]:
+    """Apply a coroutine function to items with at most concurrency of them in flight, preserving order"""
+    results = {}
+    indexed_items = enumerate(items)
+
+    async def worker():
+        # The workers share the iterator, so items are only produced when a worker is free
+        for index, item in indexed_items:
+            results[index] = await func(item)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        # Stop the other workers before the caller releases what they use, e.g. the response cache
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    return [results[index] for index in range(len(results))]
+
+
+def get_cache_dir() -> str:
+    """Get the directory to persist caches in"""
+    return os.getenv("GEMINI_CODE_REVIEW_CACHE_DIR") or os.getenv("RUNNER_TEMP") or tempfile.gettempdir()
+
+
+def open_response_cache(path: str) -> sqlite3.Connection:
+    """Open the cache of Gemini responses, creating it if needed"""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, ts INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS semantic_responses "
+                 "(key TEXT PRIMARY KEY, scope TEXT, embedding BLOB, response TEXT, ts INTEGER)")
+    return conn
+
+
+@contextlib.contextmanager
+def open_response_cache_if_enabled(cache_ttl: int) -> Iterator[Optional[sqlite3.Connection]]:
+    """Open the cache of Gemini responses, yielding None when it is disabled or cannot be opened"""
+    conn = None
+    if cache_ttl > 0:
+        cache_dir = get_cache_dir()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            conn = open_response_cache(os.path.join(cache_dir, RESPONSE_CACHE_FILE_NAME))
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Unable to open the response cache in {cache_dir}, reviewing without it: {e}")
+    try:
+        yield conn
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def get_cache_key(*parts: str) -> str:
+    """Get the key of a Gemini response in the cache"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def get_cached_response(conn: sqlite3.Connection, key: str, ttl: int) -> Optional[str]:
+    """Get a cached Gemini response if it is younger than ttl seconds"""
+    row = conn.execute("SELECT response FROM responses WHERE key = ? AND ts > ?",
+                       (key, int(time.time()) - ttl)).fetchone()
+    return row[0] if row else None
+
+
+def put_cached_response(conn: sqlite3.Connection, key: str, response: str):
+    """Cache a Gemini response"""
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO responses (key, response, ts) VALUES (?, ?, ?)",
+                     (key, response, int(time.time())))
+
+
+def get_similar_cached_response(
+        conn: sqlite3.Connection,
+        scope: str,
+        embedding: List[float],
+        threshold: float,
+        ttl: int
+) -> Optional[str]:
+    """Get the cached Gemini response whose chunk is the most similar to the embedding, above threshold"""
+    best_score, best_response = threshold, None
+    rows = conn.execute("SELECT embedding, response FROM semantic_responses WHERE scope = ? AND ts > ?",
+                        (scope, int(time.time()) - ttl))
+    for blob, response in rows:
+        # Embeddings are stored normalized, so the dot product is the cosine similarity
+        score = sum(a * b for a, b in zip(embedding, array.array("f", blob)))
+        if score > best_score:
+            best_score, best_response = score, response
+    return best_response
+
+
+def put_similar_cached_response(
+        conn: sqlite3.Connection,
+        key: str,
+        scope: str,
+        embedding: List[float],
+        response: str):
+    """Cache a Gemini response with the embedding of its chunk"""
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO semantic_responses (key, scope, embedding, response, ts) "
+                     "VALUES (?, ?, ?, ?, ?)",
+                     (key, scope, array.array("f", embedding).tobytes(), response, int(time.time())))
+
+
+async def read_streamed_text(response) -> str:
+    """Accumulate the text of a streamed Gemini response"""
+    texts = []
+    last_chunk = None
+    async for chunk in response:
+        last_chunk = chunk
+        # Chunks only carrying a finish reason, e.g. the last one or a SAFETY stop, have no text
+        if not chunk.candidates or not chunk.candidates[0].content.parts:
+            continue
+        logger.trace(f"Streamed AI: {chunk.text}")
+        texts.append(chunk.text)
+    if not texts:
+        finish_reason = last_chunk.candidates[0].finish_reason if last_chunk and last_chunk.candidates else None
+        prompt_feedback = last_chunk.prompt_feedback if last_chunk else None
+        logger.warning(f"Gemini response ended without any text, finish reason: {finish_reason}, "
+                       f"prompt feedback: {prompt_feedback}")
+    return "".join(texts)
+
+
+@retry_on_rate_limit()
+async def embed_chunk(chunked_diff: str) -> List[float]:
+    """Get the normalized embedding of a chunk of a diff"""
+    response = await genai.embed_content_async(model=EMBEDDING_MODEL, content=chunked_diff)
+    embedding = response["embedding"]
+    norm = math.sqrt(sum(value * value for value in embedding)) or 1.0
+    return [value / norm for value in embedding]
+
+
+@retry_on_rate_limit()
+async def review_chunk(genai_model: genai.GenerativeModel, chunked_diff: str) -> str:
+    """Review a single chunk of a diff, the review prompt being the model's system instruction"""
+    response = await genai_model.generate_content_async(chunked_diff, stream=True)
+    review_result = await read_streamed_text(response)
+    logger.debug(f"Response AI: {review_result}")
+    return review_result
+
+
+@retry_on_rate_limit()
+async def summarize_reviews(
+        genai_model: genai.GenerativeModel,
+        summarize_prompt: str,
+        chunked_reviews_join: str
+) -> str:
+    """Summarize the reviews of all chunks in a single stateless request"""
+    response = await genai_model.generate_content_async([summarize_prompt, chunked_reviews_join], stream=True)
+    summarized_review = await read_streamed_text(response)
+    logger.debug(f"Response AI: {summarized_review}")
+    return summarized_review
+
+
+def deduplicate_reviews(chunked_reviews: List[str]) -> List[str]:
+    """Drop the reviews identical to an earlier one, preserving order"""
+    seen_digests = set()
+    unique_reviews = []
+    for chunked_review in chunked_reviews:
+        digest = hashlib.blake2b(chunked_review.encode("utf-8"), digest_size=8).digest()
+        if digest not in seen_digests:
+            seen_digests.add(digest)
+            unique_reviews.append(chunked_review)
+    return unique_reviews
+
+
+def get_first_sentence(review: str) -> str:
+    """Get the first sentence of a review, skipping its headings"""
+    for line in review.splitlines():
+        line = line.strip()
+        if line and not HEADING_LINE_PATTERN.match(line):
+            return SENTENCE_END_PATTERN.split(line, 1)[0]
+    return ""
+
+
+def summarize_reviews_locally(chunked_reviews: List[str]) -> str:
+    """Summarize reviews with the first sentence of each, as plain text fitting in the comment's summary"""
+    first_sentences = [get_first_sentence(chunked_review) for chunked_review in chunked_reviews]
+    return " ".join(sentence for sentence in first_sentences if sentence)
+
+
+@contextlib.asynccontextmanager
+async def open_review_model(model: str, generation_config: dict, review_instruction: str):
+    """Open the model reviewing chunks, backed by a Gemini context cache when the instruction is large enough"""
+    review_model = get_model(model, generation_config=generation_config, system_instruction=review_instruction)
+    # A token is at least one character, so only count tokens when the instruction may be cacheable
+    context_cache = None
+    if len(review_instruction) >= CONTEXT_CACHE_MIN_TOKENS:
+        try:
+            # The bare model has no system instruction, which would otherwise be counted twice
+            token_count = (await get_model(model).count_tokens_async(review_instruction)).total_tokens
+            if token_count >= CONTEXT_CACHE_MIN_TOKENS:
+                context_cache = await asyncio.to_thread(genai.caching.CachedContent.create,
+                                                        model=model,
+                                                        system_instruction=review_instruction,
+                                                        ttl=CONTEXT_CACHE_TTL)
+        except google_exceptions.GoogleAPIError as e:
+            logger.warning(f"Unable to create a context cache, sending the review prompt with every chunk: {e}")
+
+    if context_cache is None:
+        yield review_model
+        return
+    try:
+        yield genai.GenerativeModel.from_cached_content(cached_content=context_cache,
+                                                        generation_config=generation_config)
+    finally:
+        await asyncio.to_thread(context_cache.delete)
+
+
+async def get_review(
         model: str,
         diff: str,
         extra_prompt: str,
@@ -94,51 +449,80 @@ def get_review(
         top_p: float,
         frequency_penalty: float,
         presence_penalty: float,
-        prompt_chunk_size: int
+        prompt_chunk_size: int,
+        cache_ttl: int = 0,
+        semantic_cache_threshold: float = 1.0
 ):
     """Get a review"""
     # Chunk the prompt
     review_prompt = get_review_prompt(extra_prompt=extra_prompt)
-    chunked_diff_list = chunk_string(input_string=diff, chunk_size=prompt_chunk_size)
+    chunked_diffs = await chunk_by_tokens(model=model, input_string=diff, max_tokens=prompt_chunk_size)
     generation_config = {
         "temperature": 1,
         "top_p": 0.95,
         "top_k": 0,
         "max_output_tokens": 8192,
     }
-    genai_model = genai.GenerativeModel(model_name=model,generation_config=generation_config,system_instruction=extra_prompt)
-    # Get summary by chunk
-    chunked_reviews = []
-    for chunked_diff in chunked_diff_list:
-        convo = genai_model.start_chat(history=[
-            {
-                "role": "user",
-                "parts": [review_prompt]
-            },
-            {
-                "role": "model",
-                "parts": ["Ok"]
-            },
-        ])
-        convo.send_message(chunked_diff)
-        review_result = convo.last.text
-        logger.debug(f"Response AI: {review_result}")
-        chunked_reviews.append(review_result)
+    # The review prompt is sent once as the system instruction rather than as chat history for every chunk
+    review_instruction = f"{review_prompt}\n{extra_prompt}"
+    summarize_model = get_model(model, generation_config=generation_config, system_instruction=extra_prompt)
+    # Get summary by chunk, concurrently but bounded to avoid hammering the API
+    scope = get_cache_key(model, review_instruction)
+    async with open_review_model(model, generation_config, review_instruction) as review_model:
+        with open_response_cache_if_enabled(cache_ttl) as cache:
+            use_semantic_cache = cache is not None and semantic_cache_threshold < 1.0
+
+            async def get_chunk_review(chunked_diff: str) -> str:
+                # Reuse the review of an identical chunk, e.g. when a workflow is re-run
+                key = get_cache_key(model, review_instruction, chunked_diff)
+                if cache is not None:
+                    cached_review = get_cached_response(cache, key, cache_ttl)
+                    if cached_review:
+                        logger.debug(f"Reusing cached review for chunk {key}")
+                        return cached_review
+
+                # Reuse the review of a nearly identical chunk, e.g. after a push changing a single line
+                embedding = None
+                if use_semantic_cache and len(chunked_diff) <= SEMANTIC_CACHE_MAX_CHARS:
+                    try:
+                        embedding = await embed_chunk(chunked_diff)
+                    except google_exceptions.GoogleAPIError as e:
+                        logger.warning(f"Unable to embed chunk {key}, reviewing it without the semantic cache: {e}")
+                    if embedding is not None:
+                        cached_review = get_similar_cached_response(
+                            cache, scope, embedding, semantic_cache_threshold, cache_ttl)
+                        if cached_review:
+                            logger.debug(f"Reusing cached review of a similar chunk for chunk {key}")
+                            return cached_review
+
+                review_result = await review_chunk(review_model, chunked_diff)
+                # An empty review, e.g. of a blocked response, is not worth reusing
+                if cache is not None and review_result:
+                    put_cached_response(cache, key, review_result)
+                if embedding is not None and review_result:
+                    put_similar_cached_response(cache, key, scope, embedding, review_result)
+                return review_result
+
+            chunked_reviews = await map_bounded(get_chunk_review, chunked_diffs, GEMINI_CONCURRENCY)
     # If the chunked reviews are only one, return it
 
     if len(chunked_reviews) == 1:
         return chunked_reviews, chunked_reviews[0]
 
-    if len(chunked_reviews) == 0:
+    # Identical reviews, e.g. of chunks repeating the same boilerplate, are only summarized once
+    unique_reviews = deduplicate_reviews(chunked_reviews)
+
+    # A few reviews are summarized locally rather than with another round-trip to Gemini
+    if 0 < len(unique_reviews) <= LOCAL_SUMMARY_MAX_REVIEWS:
+        return chunked_reviews, summarize_reviews_locally(unique_reviews)
+
+    if len(unique_reviews) == 0:
         summarize_prompt = "Say that you didn't find any relevant changes to comment on any file"
     else:
         summarize_prompt = get_summarize_prompt()
 
-    chunked_reviews_join = "\n".join(chunked_reviews)
-    convo = genai_model.start_chat(history=[])
-    convo.send_message(summarize_prompt+"\n\n"+chunked_reviews_join)
-    summarized_review = convo.last.text
-    logger.debug(f"Response AI: {summarized_review}")
+    chunked_reviews_join = "\n".join(unique_reviews)
+    summarized_review = await summarize_reviews(summarize_model, summarize_prompt, chunked_reviews_join)
     return chunked_reviews, summarized_review
 
 
@@ -157,26 +541,121 @@ def format_review_comment(summarized_review: str, chunked_reviews: List[str]) ->
 
 def parse_github_comment(comment: str) -> dict:
     """Parse GitHub comment to determine command type and options"""
-    command_map = {
-        "gemini review all": "all",
-        "gemini review diff": "diff",
-        "gemini suggest next steps": "suggest"
-    }
-    
+    match = COMMAND_PATTERN.match(comment.strip().lower())
+
     # Default to diff if no command found
-    command_type = "diff"
-    for cmd, cmd_type in command_map.items():
-        if comment.strip().lower().startswith(cmd):
-            command_type = cmd_type
-            break
-            
+    command_type = COMMAND_MAP[match.group(1)] if match else "diff"
+
     return {
         "command_type": command_type,
         "raw_comment": comment
     }
 
 
-def get_repository_contents(
+def build_blob_text_query(file_paths: List[str], ref: str = "main") -> str:
+    """Build a GraphQL query returning the text of many files in a single request"""
+    fields = "\n".join(
+        f"    file{index}: object(expression: {json.dumps(f'{ref}:{file_path}')}) "
+        f"{{ ... on Blob {{ text isTruncated }} }}"
+        for index, file_path in enumerate(file_paths)
+    )
+    return f"""query($owner: String!, $name: String!) {{
+  repository(owner: $owner, name: $name) {{
+{fields}
+  }}
+}}"""
+
+
+async def get_file_texts_by_graphql(
+    session: aiohttp.ClientSession,
+    github_repository: str,
+    blobs: List[dict]
+) -> List[Optional[str]]:
+    """Get the text of blobs with the GitHub GraphQL API, None for binary files"""
+    owner, name = github_repository.split("/", 1)
+    file_paths = [blob["path"] for blob in blobs]
+
+    async def fetch_batch(batch: List[str]) -> List[Optional[dict]]:
+        data = {
+            "query": build_blob_text_query(batch),
+            "variables": {"owner": owner, "name": name}
+        }
+        async with session.post(GITHUB_GRAPHQL_URL, json=data) as response:
+            payload = await response.json()
+        if payload.get("errors"):
+            raise ValueError(f"GitHub GraphQL query failed: {payload['errors']}")
+        repository = payload["data"]["repository"]
+        return [repository[f"file{index}"] for index in range(len(batch))]
+
+    batches = await asyncio.gather(*[
+        fetch_batch(file_paths[i:i + GITHUB_GRAPHQL_BATCH_SIZE])
+        for i in range(0, len(file_paths), GITHUB_GRAPHQL_BATCH_SIZE)
+    ])
+    file_objects = [file_object for batch in batches for file_object in batch]
+    file_texts = [(file_object or {}).get("text") for file_object in file_objects]
+
+    # GraphQL truncates the text of large files, so fetch those in full from the blobs API
+    truncated = [index for index, file_object in enumerate(file_objects)
+                 if file_object and file_object.get("isTruncated")]
+    if truncated:
+        full_texts = await get_file_texts_by_blobs(
+            session, github_repository, [blobs[index]["sha"] for index in truncated])
+        for index, text in zip(truncated, full_texts):
+            file_texts[index] = text
+    return file_texts
+
+
+async def get_file_texts_by_blobs(
+    session: aiohttp.ClientSession,
+    github_repository: str,
+    file_shas: List[str]
+) -> List[Optional[str]]:
+    """Get the text of files with the GitHub Git blobs API, one request per file, None for binary files"""
+    semaphore = asyncio.Semaphore(GITHUB_CONCURRENCY)
+    # Ask for the raw bytes of the blobs rather than base64 wrapped in JSON
+    headers = {"Accept": "application/vnd.github.raw"}
+
+    async def fetch_blob(file_sha: str) -> Optional[str]:
+        blob_url = f"https://api.github.com/repos/{github_repository}/git/blobs/{file_sha}"
+        async with semaphore, session.get(blob_url, headers=headers) as response:
+            content = await response.read()
+        if b"\0" in content:
+            return None
+        return content.decode("utf-8", errors="replace")
+
+    # gather preserves the order of the files
+    return list(await asyncio.gather(*[fetch_blob(file_sha) for file_sha in file_shas]))
+
+
+async def get_repository_tree(session: aiohttp.ClientSession, github_repository: str) -> List[dict]:
+    """Get the recursive tree of a repository, revalidating the tree cached by a previous run with its ETag"""
+    cache_path = os.path.join(get_cache_dir(), f"tree-{get_cache_key(github_repository)}.json")
+    cached_tree = None
+    with contextlib.suppress(OSError, ValueError):
+        with open(cache_path, encoding="utf-8") as f:
+            cached_tree = json.load(f)
+    if not isinstance(cached_tree, dict) or "etag" not in cached_tree or "tree" not in cached_tree:
+        cached_tree = None
+
+    # A 304 Not Modified response does not count against the rate limit
+    headers = {"If-None-Match": cached_tree["etag"]} if cached_tree else {}
+    url = f"https://api.github.com/repos/{github_repository}/git/trees/main?recursive=1"
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            logger.debug("Repository tree not modified, using the cached tree")
+            return cached_tree["tree"]
+        tree = (await response.json())["tree"]
+        etag = response.headers.get("ETag")
+
+    # The cache is best effort, e.g. its directory may be missing or read-only
+    if etag:
+        with contextlib.suppress(OSError):
+            with open(cache_path, "w", encoding="utf-8") as f:
+                json.dump({"etag": etag, "tree": tree}, f)
+    return tree
+
+
+async def get_repository_contents(
     github_token: str,
     github_repository: str,
     include_extensions: List[str] = None,
@@ -187,49 +666,43 @@ def get_repository_contents(
         "Accept": "application/vnd.github.v3+json",
         "authorization": f"Bearer {github_token}"
     }
-    
-    # Get repository contents recursively
-    url = f"https://api.github.com/repos/{github_repository}/git/trees/main?recursive=1"
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    
-    files_content = []
-    for item in response.json()["tree"]:
-        if item["type"] != "blob":
-            continue
-            
-        file_path = item["path"]
-        # Skip if not in include_extensions and not in always_include_files
-        if include_extensions and not any(file_path.endswith(ext) for ext in include_extensions):
-            if not always_include_files or file_path not in always_include_files:
+
+    async with aiohttp.ClientSession(headers=headers, raise_for_status=True) as session:
+        # Get repository contents recursively
+        tree = await get_repository_tree(session, github_repository)
+
+        # str.endswith checks a tuple of suffixes in a single call
+        extensions = tuple(include_extensions) if include_extensions else None
+        always_included = frozenset(always_include_files or ())
+        blobs = []
+        for item in tree:
+            if item["type"] != "blob":
+                continue
+
+            file_path = item["path"]
+            # Skip if not in include_extensions and not in always_include_files
+            if extensions and not file_path.endswith(extensions) and file_path not in always_included:
                 continue
-                
-        # Get file contents
-        file_url = f"https://api.github.com/repos/{github_repository}/contents/{file_path}"
-        file_response = requests.get(file_url, headers=headers)
-        file_response.raise_for_status()
-        
-        content = file_response.json()["content"]
-        files_content.append(f"File: {file_path}\n{content}\n")
-        
+            blobs.append(item)
+
+        # Get file contents, preferring a handful of GraphQL queries over one REST call per file
+        file_paths = [blob["path"] for blob in blobs]
+        try:
+            file_texts = await get_file_texts_by_graphql(session, github_repository, blobs)
+        except (aiohttp.ClientError, ValueError) as e:
+            logger.warning(f"GitHub GraphQL API unavailable, falling back to the blobs API: {e}")
+            file_texts = await get_file_texts_by_blobs(
+                session, github_repository, [blob["sha"] for blob in blobs])
+
+    files_content = [
+        f"File: {file_path}\n{text}\n"
+        for file_path, text in zip(file_paths, file_texts)
+        if text is not None
+    ]
     return "\n".join(files_content)
 
 
-@click.command()
-@click.option("--diff", type=click.STRING, required=False, help="Pull request diff")
-@click.option("--diff-chunk-size", type=click.INT, required=False, default=3500, help="Pull request diff chunk size")
-@click.option("--model", type=click.STRING, required=False, default="gpt-3.5-turbo", help="Model")
-@click.option("--extra-prompt", type=click.STRING, required=False, default="", help="Extra prompt")
-@click.option("--temperature", type=click.FLOAT, required=False, default=0.1, help="Temperature")
-@click.option("--max-tokens", type=click.INT, required=False, default=512, help="Max tokens")
-@click.option("--top-p", type=click.FLOAT, required=False, default=1.0, help="Top N")
-@click.option("--frequency-penalty", type=click.FLOAT, required=False, default=0.0, help="Frequency penalty")
-@click.option("--presence-penalty", type=click.FLOAT, required=False, default=0.0, help="Presence penalty")
-@click.option("--log-level", type=click.STRING, required=False, default="INFO", help="Log level")
-@click.option("--github-comment", type=click.STRING, required=False, help="GitHub comment content")
-@click.option("--include-extensions", type=click.STRING, required=False, help="Comma-separated list of file extensions to include")
-@click.option("--always-include-files", type=click.STRING, required=False, help="Comma-separated list of files to always include")
-def main(
+async def async_main(
         diff: str,
         diff_chunk_size: int,
         model: str,
@@ -242,8 +715,11 @@ def main(
         log_level: str,
         github_comment: str,
         include_extensions: str,
-        always_include_files: str
+        always_include_files: str,
+        cache_ttl: int,
+        semantic_cache_threshold: float
 ):
+    """Review a pull request and post the result as a comment"""
     # Set log level
     logger.level(log_level)
     
@@ -252,7 +728,7 @@ def main(
 
     # Set the Gemini API key
     api_key = os.getenv("GEMINI_API_KEY")
-    genai.configure(api_key=api_key)
+    configure_genai(api_key=api_key)
 
     # Parse GitHub comment if provided
     command_info = parse_github_comment(github_comment) if github_comment else {"command_type": "diff"}
@@ -261,11 +737,17 @@ def main(
     include_extensions_list = include_extensions.split(",") if include_extensions else None
     always_include_files_list = always_include_files.split(",") if always_include_files else None
     
+    # Get the pull request to comment on
+    github_token = os.getenv("GITHUB_TOKEN")
+    github_repository = os.getenv("GITHUB_REPOSITORY")
+    pull_request_number = int(os.getenv("GITHUB_PULL_REQUEST_NUMBER"))
+    git_commit_hash = os.getenv("GIT_COMMIT_HASH")
+
     # Get content based on command type
     if command_info["command_type"] == "all":
-        content = get_repository_contents(
-            github_token=os.getenv("GITHUB_TOKEN"),
-            github_repository=os.getenv("GITHUB_REPOSITORY"),
+        content = await get_repository_contents(
+            github_token=github_token,
+            github_repository=github_repository,
             include_extensions=include_extensions_list,
             always_include_files=always_include_files_list
         )
@@ -273,7 +755,7 @@ def main(
         content = diff
 
     # Request a code review
-    chunked_reviews, summarized_review = get_review(
+    chunked_reviews, summarized_review = await get_review(
         diff=content,
         extra_prompt=extra_prompt,
         model=model,
@@ -282,7 +764,9 @@ def main(
         top_p=top_p,
         frequency_penalty=frequency_penalty,
         presence_penalty=presence_penalty,
-        prompt_chunk_size=diff_chunk_size
+        prompt_chunk_size=diff_chunk_size,
+        cache_ttl=cache_ttl,
+        semantic_cache_threshold=semantic_cache_threshold
     )
     logger.debug(f"Summarized review: {summarized_review}")
     logger.debug(f"Chunked reviews: {chunked_reviews}")
@@ -292,14 +776,69 @@ def main(
                                            chunked_reviews=chunked_reviews)
     # Create a comment to a pull request
     create_a_comment_to_pull_request(
-        github_token=os.getenv("GITHUB_TOKEN"),
-        github_repository=os.getenv("GITHUB_REPOSITORY"),
-        pull_request_number=int(os.getenv("GITHUB_PULL_REQUEST_NUMBER")),
-        git_commit_hash=os.getenv("GIT_COMMIT_HASH"),
+        github_token=github_token,
+        github_repository=github_repository,
+        pull_request_number=pull_request_number,
+        git_commit_hash=git_commit_hash,
         body=review_comment
     )
 
 
+@click.command()
+@click.option("--diff", type=click.STRING, required=False, help="Pull request diff")
+@click.option("--diff-chunk-size", type=click.INT, required=False, default=3500,
+              help="Pull request diff chunk size in tokens")
+@click.option("--model", type=click.STRING, required=False, default="gpt-3.5-turbo", help="Model")
+@click.option("--extra-prompt", type=click.STRING, required=False, default="", help="Extra prompt")
+@click.option("--temperature", type=click.FLOAT, required=False, default=0.1, help="Temperature")
+@click.option("--max-tokens", type=click.INT, required=False, default=512, help="Max tokens")
+@click.option("--top-p", type=click.FLOAT, required=False, default=1.0, help="Top N")
+@click.option("--frequency-penalty", type=click.FLOAT, required=False, default=0.0, help="Frequency penalty")
+@click.option("--presence-penalty", type=click.FLOAT, required=False, default=0.0, help="Presence penalty")
+@click.option("--log-level", type=click.STRING, required=False, default="INFO", help="Log level")
+@click.option("--github-comment", type=click.STRING, required=False, help="GitHub comment content")
+@click.option("--include-extensions", type=click.STRING, required=False, help="Comma-separated list of file extensions to include")
+@click.option("--always-include-files", type=click.STRING, required=False, help="Comma-separated list of files to always include")
+@click.option("--cache-ttl", type=click.INT, required=False, default=604800,
+              help="Seconds to reuse a cached review of an identical chunk, 0 to disable")
+@click.option("--semantic-cache-threshold", type=click.FLOAT, required=False, default=1.0,
+              help="Cosine similarity above which the cached review of a similar chunk is reused, 1 to disable")
+def main(
+        diff: str,
+        diff_chunk_size: int,
+        model: str,
+        extra_prompt: str,
+        temperature: float,
+        max_tokens: int,
+        top_p: float,
+        frequency_penalty: float,
+        presence_penalty: float,
+        log_level: str,
+        github_comment: str,
+        include_extensions: str,
+        always_include_files: str,
+        cache_ttl: int,
+        semantic_cache_threshold: float
+):
+    asyncio.run(async_main(
+        diff=diff,
+        diff_chunk_size=diff_chunk_size,
+        model=model,
+        extra_prompt=extra_prompt,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        top_p=top_p,
+        frequency_penalty=frequency_penalty,
+        presence_penalty=presence_penalty,
+        log_level=log_level,
+        github_comment=github_comment,
+        include_extensions=include_extensions,
+        always_include_files=always_include_files,
+        cache_ttl=cache_ttl,
+        semantic_cache_threshold=semantic_cache_threshold
+    ))
+
+
 if __name__ == "__main__":
     # pylint: disable=no-value-for-parameter
     main()